@@ -5,19 +5,35 @@ Convert TTF fonts into VLW bitmap fonts for LovyanGFX / M5GFX.
 This is a minimal converter that produces the subset of glyphs we need
 for the e-reader: ASCII, Latin-1 punctuation, and the full Hebrew block.
 
+The output is read on the device by M5GFX's loadFont(), which fixes the
+layout: a big-endian 24-byte header, one 28-byte record per glyph sorted
+by codepoint, then every bitmap back to back at 1 byte (alpha) per pixel
+in record order. The encoder version word is ignored by the reader, so
+the bitmap depth cannot be changed from this side.
+
 Usage (run from repo root):
-    python tools/generate_vlw_fonts.py
+    python tools/generate_vlw_fonts.py [--jobs N]
 
 Requires Pillow:
     pip install pillow
+
+Pillow-SIMD is a drop-in replacement with faster raster kernels and is
+picked up automatically when installed:
+    pip uninstall pillow && pip install pillow-simd
 """
+import argparse
+import multiprocessing.pool
 import os
 import struct
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import chain
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 try:
-    from PIL import ImageFont, Image, ImageDraw
+    from PIL import ImageFont, Image
 except ImportError as exc:
     raise SystemExit("Pillow is required. Install with: pip install pillow") from exc
 
@@ -74,12 +90,149 @@ FONT_JOBS = [
     ]),
 ]
 
-def build_vlw(out_path: Path, size: int, sources: List[Tuple[str, List[Iterable[int]]]]) -> None:
+# Big endian is part of the VLW format: M5GFX byte-swaps every header and
+# glyph field on load and has no little-endian variant to dispatch to.
+VLW_HEADER = struct.Struct(">6I")
+GLYPH_RECORD_FMT = "IIIIiii"
+
+# (codepoint, height, width, xAdvance, dY, dX, bitmap)
+Glyph = Tuple[int, int, int, int, int, int, bytes]
+# (source_path, pixel_size, codepoint)
+GlyphKey = Tuple[str, int, int]
+
+# A codepoint no font maps, used to capture each font's .notdef rendering
+_MISSING_CHAR = "\U0010FFFF"
+
+
+@lru_cache(maxsize=None)
+def _load_font(src_path: str, size: int) -> "ImageFont.FreeTypeFont":
+    """Parse a font file once per process; several jobs share the same TTF and size.
+
+    Glyphs are rasterized one codepoint at a time, so there is nothing for
+    raqm's bidi/shaping pass to do; the basic layout engine skips that setup
+    on every getmask2/getlength call.
+    """
+    return ImageFont.truetype(src_path, size, layout_engine=ImageFont.Layout.BASIC)
+
+
+def _mask_bytes(mask) -> bytes:
+    """Raw L-mode bytes of a core mask.
+
+    bytes(mask) walks the core object's sequence protocol pixel by pixel;
+    wrapping it in an Image and calling tobytes() uses Pillow's C encoder.
+    """
+    return Image.Image()._new(mask).tobytes()
+
+
+def _notdef_key(font: "ImageFont.FreeTypeFont") -> tuple:
+    """Content key of the box a font draws for codepoints it does not map."""
+    try:
+        mask = font.getmask(_MISSING_CHAR, mode="L")
+    except Exception:
+        return ((0, 0), b"")
+    return (mask.size, _mask_bytes(mask))
+
+
+@lru_cache(maxsize=None)
+def _glyph_context(src_path: str, size: int) -> Tuple["ImageFont.FreeTypeFont", int, tuple]:
+    """Font plus the per-font values every glyph needs: ascent and .notdef key.
+
+    ImageFont objects cannot be pickled, so each rasterization worker builds
+    its own context on first use.
+    """
+    font = _load_font(src_path, size)
+    return font, font.getmetrics()[0], _notdef_key(font)
+
+
+def _render_glyph(job: GlyphKey) -> Optional[Glyph]:
+    """Rasterize one codepoint in a worker process; None if the glyph is empty."""
+    src_path, size, cp = job
+    font, ascent, notdef = _glyph_context(src_path, size)
+
+    ch = chr(cp)
+    try:
+        # getmask2 returns the ink box offset along with the mask, so the
+        # glyph is only shaped once instead of again for textbbox()
+        mask, (g_dx, top) = font.getmask2(ch, mode="L")
+    except Exception:
+        return None
+
+    w, h = mask.size
+    if w == 0 or h == 0:
+        return None  # skip empty glyphs
+
+    # Each mask is converted to bytes at most once: the .notdef comparison
+    # result is reused unless cropping replaces the mask
+    bitmap = None
+    if mask.size == notdef[0]:
+        bitmap = _mask_bytes(mask)
+        if bitmap == notdef[1]:
+            return None  # not in this font; leave it to the next source
+
+    # Trim transparent rows/columns the rasterizer left around the ink.
+    # Blank glyphs keep their full mask so their advance is preserved.
+    ink = mask.getbbox()
+    if ink is not None and ink != (0, 0, w, h):
+        mask = mask.crop(ink)
+        w, h = mask.size
+        g_dx += ink[0]
+        top += ink[1]
+        bitmap = None
+
+    x_advance = round(font.getlength(ch))
+
+    # Use font-specific ascent for d_y calculation to align baselines
+    d_y = ascent - top
+
+    if bitmap is None:
+        bitmap = _mask_bytes(mask)
+
+    return (cp, h, w, x_advance, d_y, g_dx, bitmap)
+
+
+# Narrowed per-glyph arrays M5GFX's loadFont() copies each 28-byte record
+# into: (field name, record index, min, max)
+_READER_FIELD_LIMITS = (
+    ("codepoint", 0, 0, 0xFFFF),
+    ("height", 1, 0, 0xFF),
+    ("width", 2, 0, 0xFF),
+    ("xAdvance", 3, 0, 0xFF),
+    ("dY", 4, -0x8000, 0x7FFF),
+    ("dX", 5, -0x80, 0x7F),
+)
+
+
+def _check_reader_limits(glyphs: List[Glyph]) -> Optional[str]:
+    """Describe the first value M5GFX would silently truncate on load, if any."""
+    if len(glyphs) > 0xFFFF:
+        return f"{len(glyphs)} glyphs exceed M5GFX's 16-bit glyph count"
+    for name, idx, lo, hi in _READER_FIELD_LIMITS:
+        values = [g[idx] for g in glyphs]
+        if values and (min(values) < lo or max(values) > hi):
+            bad = next(g for g in glyphs if not lo <= g[idx] <= hi)
+            return f"U+{bad[0]:04X} {name}={bad[idx]} is outside M5GFX's range [{lo}, {hi}]"
+    return None
+
+
+def build_vlw(out_path: Path, size: int, sources: List[Tuple[str, List[Iterable[int]]]],
+              rendered: Optional[Dict[GlyphKey, Optional[Glyph]]] = None,
+              pool: Optional[multiprocessing.pool.Pool] = None) -> None:
+    """Write one VLW font.
+
+    ``rendered`` caches rasterized glyphs by (source, size, codepoint) so jobs
+    that pull the same ranges from the same font (Roboto's Latin ranges in
+    several outputs) only rasterize them once; pass one dict to every call.
+    ``pool`` is the worker pool to rasterize with; a private one is created
+    when it is omitted.
+    """
+    if rendered is None:
+        rendered = {}
+
     # Load all source fonts
     loaded_fonts = []
     for src_path, ranges in sources:
         try:
-            font = ImageFont.truetype(src_path, size)
+            font = _load_font(src_path, size)
             loaded_fonts.append((font, ranges))
         except Exception as e:
             print(f"Error loading {src_path}: {e}")
@@ -95,68 +248,86 @@ def build_vlw(out_path: Path, size: int, sources: List[Tuple[str, List[Iterable[
     
     y_advance = max_ascent + max_descent
 
-    dummy = Image.new("L", (1, 1))
-    draw = ImageDraw.Draw(dummy)
-
-    glyphs: List[Tuple[int, int, int, int, int, int, bytes]] = []
+    glyphs: List[Glyph] = []
     processed_cps = set()
 
-    # Process fonts in order
-    for font, ranges in loaded_fonts:
-        # Flatten ranges
-        cps = []
-        for r in ranges:
-            cps.extend(list(r))
-        
-        for cp in sorted(set(cps)):
-            if cp in processed_cps:
-                continue
-            
-            ch = chr(cp)
-            try:
-                mask = font.getmask(ch, mode="L")
-            except Exception:
-                continue
-                
-            w, h = mask.size
-            if w == 0 or h == 0:
-                continue  # skip empty glyphs
-            
-            bbox = draw.textbbox((0, 0), ch, font=font)
-            x_advance = round(font.getlength(ch))
-            
-            # Use font-specific ascent for d_y calculation to align baselines
-            ascent, _ = font.getmetrics()
-            d_y = ascent - bbox[1]
-            g_dx = bbox[0]
-            
-            glyphs.append((cp, h, w, x_advance, d_y, g_dx, bytes(mask)))
-            processed_cps.add(cp)
+    # Process fonts in order; a codepoint is taken from the first font that
+    # renders it, so each font's batch only holds codepoints still missing.
+    with (Pool() if pool is None else nullcontext(pool)) as pool:
+        for src_path, ranges in sources:
+            # Flatten and dedup the ranges, minus codepoints already taken
+            cps = set().union(*ranges)
+            cps.difference_update(processed_cps)
+
+            keys = [(src_path, size, cp) for cp in sorted(cps)]
+            work = [key for key in keys if key not in rendered]
+            for key, glyph in zip(work, pool.imap(_render_glyph, work, chunksize=64)):
+                rendered[key] = glyph
 
+            for key in keys:
+                glyph = rendered[key]
+                if glyph is None:
+                    continue
+                glyphs.append(glyph)
+                processed_cps.add(glyph[0])
+
+    # M5GFX copies the codepoints into a uint16_t array and binary searches
+    # it, so the table must be sorted and fit in the BMP to stay findable
     glyphs.sort(key=lambda x: x[0]) # Sort by codepoint
+    error = _check_reader_limits(glyphs)
+    if error:
+        print(f"Error: {out_path}: {error}")
+        return
 
-    buf = bytearray()
-    # Header: glyph count, encoder version (unused), yAdvance, reserved, ascent, descent
-    buf += struct.pack(">6I", len(glyphs), 0, y_advance, 0, max_ascent, max_descent)
+    # Glyph table: 7 * 4 bytes per glyph, big endian
+    table = struct.Struct(">" + GLYPH_RECORD_FMT * len(glyphs))
+    bitmap_start = VLW_HEADER.size + table.size
+    buf = bytearray(bitmap_start + sum(len(g[6]) for g in glyphs))
 
-    # Glyph table (7 * 4 bytes each, big endian)
-    for cp, h, w, x_adv, d_y, g_dx, _ in glyphs:
-        buf += struct.pack(">IIIIIii", cp, h, w, x_adv, d_y, g_dx, 0)
+    # Header: glyph count, encoder version (unused), yAdvance, reserved, ascent, descent
+    VLW_HEADER.pack_into(buf, 0, len(glyphs), 0, y_advance, 0, max_ascent, max_descent)
+    table.pack_into(buf, VLW_HEADER.size, *chain.from_iterable(
+        (cp, h, w, x_adv, d_y, g_dx, 0) for cp, h, w, x_adv, d_y, g_dx, _ in glyphs))
 
-    # Bitmap data (1 byte per pixel, no padding)
-    for _, h, w, _, _, _, bm in glyphs:
-        buf += bm
+    # Bitmap data (1 byte per pixel, no padding). Copy through a memoryview:
+    # its slice assignment is a fixed-size memcpy, with none of bytearray's
+    # resize handling
+    view = memoryview(buf)
+    off = bitmap_start
+    for *_, bm in glyphs:
+        end = off + len(bm)
+        view[off:end] = bm
+        off = end
+    view.release()
 
     out_path.parent.mkdir(parents=True, exist_ok=True)
-    with out_path.open("wb") as f:
-        f.write(buf)
+    # Unbuffered: the file is already assembled in one buffer, so hand it
+    # straight to the OS instead of copying it through BufferedWriter
+    with out_path.open("wb", buffering=0) as f:
+        view = memoryview(buf)
+        while view:
+            view = view[f.write(view):]
     print(f"Wrote {out_path} (glyphs: {len(glyphs)}, bytes: {len(buf)})")
 
 
 def main() -> None:
-    for dst, size, sources in FONT_JOBS:
-        out = Path(dst)
-        build_vlw(out, size, sources)
+    parser = argparse.ArgumentParser(description="Convert TTF/OTF fonts into VLW bitmap fonts.")
+    parser.add_argument('--jobs', type=int, default=0, help="Number of rasterization worker processes (0 = auto)")
+    args = parser.parse_args()
+
+    # Pillow-SIMD releases carry a ".postN" suffix on the upstream version
+    if "post" not in Image.__version__:
+        print("Hint: install pillow-simd for faster rasterization: "
+              "pip uninstall pillow && pip install pillow-simd")
+
+    # One pool serves every job: jobs run in order so later ones can reuse
+    # glyphs cached by earlier ones, and each job's batches use all workers
+    workers = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    rendered: Dict[GlyphKey, Optional[Glyph]] = {}
+    with Pool(processes=workers) as pool:
+        for dst, size, sources in FONT_JOBS:
+            out = Path(dst)
+            build_vlw(out, size, sources, rendered, pool)
 
 
 if __name__ == "__main__":
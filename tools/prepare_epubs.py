@@ -1,348 +1,484 @@
 import os
+import posixpath
 import sys
 import zipfile
 import shutil
+import copy
 import re
-import xml.etree.ElementTree as ET
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import BinaryIO, Optional, Tuple, List
 from PIL import Image
 from io import BytesIO
+from urllib.parse import unquote_to_bytes
 import argparse
 import struct
+import json
 import itertools
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+# zlib-ng, when installed, inflates and deflates several times faster than
+# stock zlib; zipfile looks its zlib functions up at call time
+try:
+    from zlib_ng import zlib_ng
+    zipfile.zlib = zlib_ng
+except ImportError:
+    pass
+
+# lxml parses and queries in C; fall back to the stdlib parser without it
+try:
+    from lxml import etree as ET
+    # Never expand entities from untrusted books
+    _XML_PARSER = ET.XMLParser(resolve_entities=False)
+
+    def _compile_path(path: str, namespaces: dict):
+        return ET.XPath(path, namespaces=namespaces)
+
+    def _iter_tags(root, *tags):
+        return root.iter(*tags)
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _XML_PARSER = None
+
+    def _compile_path(path: str, namespaces: dict):
+        return lambda root: root.findall(path, namespaces)
+
+    def _iter_tags(root, *tags):
+        return (el for el in root.iter() if el.tag in tags)
 
 SDCARD_BOOKS_ROOT = "/sdcard/books"
+CHAPTER_READ_SIZE = 64 * 1024
+# Block size for copying entry data between archives
+COPY_BLOCK_SIZE = 64 * 1024
+# Worker processes are replaced after this many books (Python 3.11+), handing
+# the memory of image-heavy books back to the OS
+BOOKS_PER_WORKER = 16
+# Per-book chapter threads; books themselves already run in parallel processes
+CHAPTER_THREADS = 4
+IMAGE_THREADS = min(8, os.cpu_count() or 1)
+# Bump whenever a rerun would produce different output for the same book,
+# e.g. when process_epub or count_chapter_length change
+PIPELINE_VERSION = 1
+# Only rewritten entries (OPF, resized images) are deflated; level 1 is
+# several times faster than zlib's default 6 and barely larger
+DEFAULT_COMPRESS_LEVEL = 1
+
+# Text bytes the C++ reader folds into a single separator
+_TEXT_WS = b" \r\n"
+# bytes.split() also breaks on \t, \v and \f, which the reader counts as
+# ordinary characters; map them to a placeholder before splitting
+_SPLIT_NEUTRAL = bytes.maketrans(b"\t\x0b\x0c", b"___")
+
+def _text_length(text: bytes, last_space: bool) -> Tuple[int, bool]:
+    """
+    Length of a run of text outside tags, given whether the previous output
+    was a separator. Returns (length, last_space) after the run.
+    Every non-whitespace byte counts once and every whitespace run counts as
+    one separator, unless it directly follows another separator.
+    bytes.split() classifies the whole run in C: k words are separated by
+    k - 1 whitespace runs, plus one at each end the text starts/ends on.
+    """
+    if not text:
+        return 0, last_space
+    words = text.translate(_SPLIT_NEUTRAL).split()
+    starts_ws = text[0] in _TEXT_WS
+    ends_ws = text[-1] in _TEXT_WS
+    length = sum(map(len, words)) + len(words) - 1 + starts_ws + ends_ws
+    if last_space and starts_ws:
+        length -= 1
+    return length, ends_ws
+
+# Tags the reader breaks text on, compared against the lowercased tag body.
+# Any tag of two or more characters starting with 'h' or '/h' counts too.
+_BLOCK_TAGS = frozenset((b"p", b"/p", b"div", b"/div", b"br", b"br/", b"li", b"/li"))
+_BLOCK_TAG_PREFIXES = (b"p ", b"/p ", b"div ", b"/div ", b"br ")
+_HEADING_TAG_PREFIXES = (b"h", b"/h")
+# 256-entry lookup: 1 for bytes that can start a block or img tag. Non-ASCII
+# bytes are kept since invalid UTF-8 is dropped before matching.
+_TAG_FIRST_BYTE = bytes(c >= 0x80 or chr(c).lower() in "pdblhi/" for c in range(256))
+
+def _decode_tag(tag: bytes) -> bytes:
+    """
+    Lowercase a tag body holding non-ASCII bytes the way the original str
+    code did (invalid UTF-8 dropped), so it can be matched as bytes.
+    ASCII tags skip this: bytes.lower() gives the same result for them.
+    """
+    return tag.decode('utf-8', errors='ignore').lower().encode('utf-8')
+
+class ChapterLengthCounter:
+    """
+    Replicates the C++ chapterLengthCallback logic to calculate text length,
+    fed one chunk at a time so a chapter can be streamed out of the zip.
+
+    Instead of stepping through every byte, the scanner jumps from tag to tag
+    with bytes.find and measures the text in between with C-level bytes
+    operations; Python code only runs once per tag. A tag cut off by the end
+    of a chunk is carried over and finished by the next one.
+    """
+
+    def __init__(self):
+        self.length = 0
+        self.last_space = True
+        self.pending = b"" # Unterminated tag, from its '<'
+
+    def feed(self, data: bytes) -> None:
+        if self.pending:
+            data = self.pending + data
+            self.pending = b""
+
+        length = self.length
+        last_space = self.last_space
+        pos = 0
+        n = len(data)
+        while pos < n:
+            lt = data.find(b"<", pos)
+            if lt < 0:
+                text_len, last_space = _text_length(data[pos:], last_space)
+                length += text_len
+                break
+
+            text_len, last_space = _text_length(data[pos:lt], last_space)
+            length += text_len
+
+            gt = data.find(b">", lt + 1)
+            if gt < 0:
+                # Only the last '<' matters, since any '<' starts the tag over
+                self.pending = data[data.rfind(b"<", lt):]
+                break
+
+            # A '<' inside a tag starts the tag over
+            current_tag = data[data.rfind(b"<", lt, gt) + 1:gt]
+            pos = gt + 1
+
+            # Most tags (span, a, em, ...) are ruled out by their first byte
+            if not current_tag or not _TAG_FIRST_BYTE[current_tag[0]]:
+                continue
+
+            # Process tag
+            if current_tag.isascii():
+                tag = current_tag.lower()
+            else:
+                tag = _decode_tag(current_tag)
+
+            if (tag in _BLOCK_TAGS or tag.startswith(_BLOCK_TAG_PREFIXES)
+                    or (len(tag) >= 2 and tag.startswith(_HEADING_TAG_PREFIXES))):
+                if not last_space:
+                    length += 1
+                    last_space = True
+            elif tag == b"img" or tag.startswith(b"img "):
+                length += 7 # [Image]
+                last_space = False
+
+        self.length = length
+        self.last_space = last_space
+
+    def finalize(self) -> int:
+        # An unterminated tag swallows the rest of the chapter
+        self.pending = b""
+        return self.length
 
 def count_chapter_length(data: bytes) -> int:
+    """Text length of a whole chapter held in memory."""
+    counter = ChapterLengthCounter()
+    counter.feed(data)
+    return counter.finalize()
+
+CONTAINER_NS = {"c": "urn:oasis:names:tc:opendocument:xmlns:container"}
+OPF_NS = {
+    "dc": "http://purl.org/dc/elements/1.1/",
+    "opf": "http://www.idpf.org/2007/opf",
+}
+
+# Compiled once per process and reused for every book; each returns a list
+_CONTAINER_ROOTFILE = _compile_path(".//c:rootfile", CONTAINER_NS)
+_OPF_ITEM = _compile_path(".//opf:item", OPF_NS)
+_OPF_ITEMREF = _compile_path(".//opf:itemref", OPF_NS)
+_DC_TITLE_TAG = f"{{{OPF_NS['dc']}}}title"
+_DC_CREATOR_TAG = f"{{{OPF_NS['dc']}}}creator"
+
+class EpubHandle:
     """
-    Replicates the C++ chapterLengthCallback logic to calculate text length.
+    An open EPUB with container.xml and the OPF parsed once.
+    The rename, metrics and index steps all read from one handle instead of
+    each reopening the zip and re-parsing the same XML.
+    If the OPF cannot be located or parsed, `error` describes why and
+    `opf_root` is None.
     """
-    length = 0
-    in_tag = False
-    last_space = True
-    current_tag = bytearray()
-    
-    i = 0
-    n = len(data)
-    while i < n:
-        c = data[i]
-        
-        if c == 60: # '<'
-            in_tag = True
-            current_tag = bytearray()
-            i += 1
+
+    def __init__(self, epub_path: Path):
+        self.path = epub_path
+        self.zf = zipfile.ZipFile(epub_path, "r")
+        self.opf_path = ""
+        self.opf_dir = ""
+        self.opf_root = None
+        self.manifest = {} # id -> href
+        self.spine_refs = []
+        self.error = None
+        try:
+            self._parse()
+        except Exception:
+            self.zf.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.zf.close()
+
+    def _parse(self):
+        # 1. Read META-INF/container.xml
+        try:
+            container_data = self.zf.read("META-INF/container.xml")
+        except KeyError:
+            self.error = "META-INF/container.xml not found."
+            return
+
+        try:
+            container_root = ET.fromstring(container_data, _XML_PARSER)
+        except Exception as e:
+            self.error = f"invalid container.xml: {e}"
+            return
+
+        rootfiles = _CONTAINER_ROOTFILE(container_root)
+        if not rootfiles:
+            self.error = "<rootfile> not found in container.xml."
+            return
+
+        opf_path = rootfiles[0].get("full-path")
+        if not opf_path:
+            self.error = "empty full-path in container.xml."
+            return
+
+        # 2. Read OPF file
+        try:
+            opf_data = self.zf.read(opf_path)
+        except KeyError:
+            self.error = f"OPF '{opf_path}' not found in archive."
+            return
+
+        try:
+            self.opf_root = ET.fromstring(opf_data, _XML_PARSER)
+        except Exception as e:
+            self.error = f"invalid OPF XML: {e}"
+            return
+
+        self.opf_path = opf_path
+        self.opf_dir = os.path.dirname(opf_path)
+
+        # 3. Manifest and Spine
+        for item in _OPF_ITEM(self.opf_root):
+            self.manifest[item.get("id")] = item.get("href")
+
+        for itemref in _OPF_ITEMREF(self.opf_root):
+            self.spine_refs.append(itemref.get("idref"))
+
+def get_metrics_path(epub_path: Path) -> Path:
+    return epub_path.parent / f"m_{epub_path.stem}.bin"
+
+def get_cache_path(epub_path: Path) -> Path:
+    return epub_path.parent / f"c_{epub_path.stem}.json"
+
+def load_cached_result(epub_path: Path, st: os.stat_result, mode: str,
+                       compress_level: int) -> Optional[dict]:
+    """
+    The index entry saved by the last run, if the book has not changed since:
+    same size and mtime, same mode and compression level and same
+    PIPELINE_VERSION. Returns None when the book has to go through the
+    pipeline again.
+    """
+    try:
+        with open(get_cache_path(epub_path), 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if (not isinstance(cache, dict)
+            or cache.get("pipeline_version") != PIPELINE_VERSION
+            or cache.get("mode") != mode
+            or cache.get("compress_level") != compress_level
+            or cache.get("size") != st.st_size
+            or cache.get("mtime_ns") != st.st_mtime_ns):
+        return None
+    if cache.get("has_metrics") and not get_metrics_path(epub_path).exists():
+        return None
+
+    return {
+        "name": epub_path.name,
+        "title": cache.get("title", epub_path.stem),
+        "author": cache.get("author", ""),
+        "size": st.st_size,
+        "has_metrics": cache.get("has_metrics", 0),
+    }
+
+def save_cached_result(epub_path: Path, st: os.stat_result, mode: str,
+                       compress_level: int, result: dict) -> None:
+    """Remember a processed book's index entry next to it."""
+    cache = {
+        "pipeline_version": PIPELINE_VERSION,
+        "mode": mode,
+        "compress_level": compress_level,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "title": result["title"],
+        "author": result["author"],
+        "has_metrics": result["has_metrics"],
+    }
+    try:
+        with open(get_cache_path(epub_path), 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+    except OSError as e:
+        print(f"[WARN] {epub_path.name}: could not write cache: {e}")
+
+def read_chapter_length(zf: zipfile.ZipFile, full_path: str):
+    """
+    Text length of one chapter, streamed out of the zip instead of inflated
+    whole. Returns the exception instead of raising it, so a chapter pool can
+    report failures in spine order.
+    """
+    try:
+        counter = ChapterLengthCounter()
+        with zf.open(full_path) as fh:
+            for block in iter(lambda: fh.read(CHAPTER_READ_SIZE), b""):
+                counter.feed(block)
+        return counter.finalize()
+    except Exception as e:
+        return e
+
+def compute_chapter_offsets(epub: EpubHandle) -> Optional[List[int]]:
+    """
+    Cumulative text length at the start of every spine chapter, plus the
+    total at the end. Returns None if the OPF could not be parsed.
+    Chapters are measured on a small thread pool: zlib releases the GIL
+    while inflating, so one chapter decompresses while another is scanned.
+    """
+    if epub.opf_root is None:
+        print(f"[ERROR] Failed to parse OPF for {epub.path.name}: {epub.error}")
+        return None
+
+    chapter_paths = []
+    for idref in epub.spine_refs:
+        if idref not in epub.manifest:
             continue
-            
-        if in_tag:
-            if c == 62: # '>'
-                in_tag = False
-                # Process tag
-                try:
-                    tag_str = current_tag.decode('utf-8', errors='ignore').lower()
-                except:
-                    tag_str = ""
-                
-                is_block = False
-                if tag_str in ["p", "/p"] or tag_str.startswith("p ") or tag_str.startswith("/p "): is_block = True
-                elif tag_str in ["div", "/div"] or tag_str.startswith("div ") or tag_str.startswith("/div "): is_block = True
-                elif tag_str in ["br", "br/"] or tag_str.startswith("br "): is_block = True
-                elif tag_str in ["li", "/li"]: is_block = True
-                elif len(tag_str) >= 2 and (tag_str[0] == 'h' or (tag_str[0] == '/' and tag_str[1] == 'h')): is_block = True
-                
-                if is_block:
-                    if not last_space:
-                        length += 1
-                        last_space = True
-                elif tag_str == "img" or tag_str.startswith("img "):
-                    length += 7 # [Image]
-                    last_space = False
+
+        href = epub.manifest[idref]
+        # Resolve path relative to OPF
+        full_path = href
+        if epub.opf_dir:
+            full_path = epub.opf_dir + "/" + href
+        chapter_paths.append(full_path.replace("\\", "/"))
+
+    chapter_offsets = []
+    cumulative_length = 0
+    chapter_offsets.append(0) # Start at 0
+
+    with ThreadPoolExecutor(max_workers=CHAPTER_THREADS) as pool:
+        lengths = pool.map(read_chapter_length, itertools.repeat(epub.zf), chapter_paths)
+        for full_path, length in zip(chapter_paths, lengths):
+            if isinstance(length, KeyError):
+                print(f"[WARN] Chapter file missing: {full_path}")
+                # Add 0 length
+            elif isinstance(length, Exception):
+                print(f"[WARN] Error reading chapter {full_path}: {length}")
             else:
-                current_tag.append(c)
-            i += 1
-            continue
-            
-        # Outside tag
-        if c == 10 or c == 13: # \n or \r
-            c = 32 # space
-            
-        if c == 32:
-            if not last_space:
-                length += 1
-                last_space = True
-        else:
-            length += 1
-            last_space = False
-            
-        i += 1
-        
-    return length
+                cumulative_length += length
+            chapter_offsets.append(cumulative_length)
+
+    return chapter_offsets
 
-def generate_metrics(epub_path: Path) -> bool:
+def generate_metrics(epub_path: Path, chapter_offsets: Optional[List[int]] = None) -> bool:
     """
-    Generates the m_<filename>.bin metrics file for the given EPUB.
+    Generates the m_<filename>.bin metrics file for the given EPUB from
+    offsets already computed by compute_chapter_offsets, opening the EPUB
+    to compute them only when they were not supplied.
     Returns True if successful.
     """
-    metrics_filename = f"m_{epub_path.stem}.bin"
-    metrics_path = epub_path.parent / metrics_filename
-    
+    metrics_path = get_metrics_path(epub_path)
+
     if metrics_path.exists():
         # print(f"Metrics already exist for {epub_path.name}")
         return True
 
     print(f"Generating metrics for {epub_path.name}...")
-    
+
     try:
-        with zipfile.ZipFile(epub_path, "r") as zf:
-            # 1. Find OPF
-            try:
-                container_data = zf.read("META-INF/container.xml")
-                container_root = ET.fromstring(container_data)
-                ns_container = {"c": "urn:oasis:names:tc:opendocument:xmlns:container"}
-                rootfile_elem = container_root.find(".//c:rootfile", ns_container)
-                opf_path = rootfile_elem.get("full-path")
-                opf_data = zf.read(opf_path)
-                opf_root = ET.fromstring(opf_data)
-            except Exception as e:
-                print(f"[ERROR] Failed to parse OPF for {epub_path.name}: {e}")
+        if chapter_offsets is None:
+            with EpubHandle(epub_path) as epub:
+                chapter_offsets = compute_chapter_offsets(epub)
+            if chapter_offsets is None:
                 return False
 
-            ns = {
-                "dc": "http://purl.org/dc/elements/1.1/",
-                "opf": "http://www.idpf.org/2007/opf",
-            }
-            
-            # 2. Get Manifest and Spine
-            manifest = {} # id -> href
-            for item in opf_root.findall(".//opf:item", ns):
-                manifest[item.get("id")] = item.get("href")
-                
-            spine_refs = []
-            for itemref in opf_root.findall(".//opf:itemref", ns):
-                spine_refs.append(itemref.get("idref"))
-                
-            # 3. Calculate metrics
-            chapter_offsets = []
-            cumulative_length = 0
-            chapter_offsets.append(0) # Start at 0
-            
-            opf_dir = os.path.dirname(opf_path)
-            
-            for idref in spine_refs:
-                if idref not in manifest:
-                    continue
-                    
-                href = manifest[idref]
-                # Resolve path relative to OPF
-                full_path = href
-                if opf_dir:
-                    full_path = opf_dir + "/" + href
-                full_path = full_path.replace("\\", "/")
-                
-                try:
-                    content = zf.read(full_path)
-                    length = count_chapter_length(content)
-                    cumulative_length += length
-                    chapter_offsets.append(cumulative_length)
-                except KeyError:
-                    print(f"[WARN] Chapter file missing: {full_path}")
-                    # Add 0 length
-                    chapter_offsets.append(cumulative_length)
-                except Exception as e:
-                    print(f"[WARN] Error reading chapter {full_path}: {e}")
-                    chapter_offsets.append(cumulative_length)
-
-            # 4. Save to .bin file
-            # Format: Version(1) | TotalChars(4) | Count(4) | Offsets...
-            # Note: chapter_offsets contains (Count + 1) entries (0 to Total).
-            # The C++ code expects:
-            # fwrite(&totalChars, sizeof(size_t), 1, f);
-            # fwrite(&count, sizeof(uint32_t), 1, f);
-            # fwrite(chapterOffsets.data(), sizeof(size_t), count, f);
-            # Wait, C++ `chapterOffsets` vector in `saveBookMetrics` seems to be the sums?
-            # In `gui.cpp`: `sums[i + 1] = cumulative;`
-            # `bookIndex.saveBookMetrics(..., sums, ...)`
-            # So `sums` has `chapters + 1` entries.
-            # `saveBookMetrics` writes `count = chapterOffsets.size()`.
-            # So it writes `chapters + 1` entries.
-            
-            with open(metrics_path, "wb") as f:
-                version = 1
-                f.write(struct.pack("<B", version))
-                f.write(struct.pack("<I", cumulative_length)) # TotalChars (size_t = 4 bytes on ESP32)
-                
-                count = len(chapter_offsets)
-                f.write(struct.pack("<I", count))
-                
-                for offset in chapter_offsets:
-                    f.write(struct.pack("<I", offset)) # size_t = 4 bytes
-                    
-            print(f"  -> Saved metrics: {cumulative_length} chars, {count} entries")
-            return True
-            
+        # Save to .bin file
+        # Format: Version(1) | TotalChars(4) | Count(4) | Offsets...
+        # chapter_offsets has (chapters + 1) entries, 0 to Total, matching the
+        # prefix sums gui.cpp passes to BookIndex::saveBookMetrics, which
+        # writes count = chapterOffsets.size() followed by the size_t offsets.
+        cumulative_length = chapter_offsets[-1]
+        with open(metrics_path, "wb") as f:
+            version = 1
+            f.write(struct.pack("<B", version))
+            f.write(struct.pack("<I", cumulative_length)) # TotalChars (size_t = 4 bytes on ESP32)
+
+            count = len(chapter_offsets)
+            f.write(struct.pack("<I", count))
+
+            for offset in chapter_offsets:
+                f.write(struct.pack("<I", offset)) # size_t = 4 bytes
+
+        print(f"  -> Saved metrics: {cumulative_length} chars, {count} entries")
+        return True
+
     except Exception as e:
         print(f"[ERROR] Failed to process {epub_path.name}: {e}")
         return False
 
-def get_metadata(epub_path: Path) -> Tuple[Optional[str], Optional[str], int]:
+def get_title_author(epub: EpubHandle) -> Tuple[Optional[str], Optional[str]]:
     """
-    Extract (title, author, file_size) from the EPUB.
-    Returns (None, None, size) on failure.
+    Extract (title, author) from the EPUB's OPF metadata.
+    Returns (None, None) on failure.
     """
-    if not epub_path.is_file():
-        return None, None, 0
-
-    size = epub_path.stat().st_size
-
-    try:
-        with zipfile.ZipFile(epub_path, "r") as zf:
-            # 1. Read META-INF/container.xml
-            try:
-                container_data = zf.read("META-INF/container.xml")
-            except KeyError:
-                return None, None, size
-
-            try:
-                container_root = ET.fromstring(container_data)
-            except Exception:
-                return None, None, size
-
-            ns_container = {
-                "c": "urn:oasis:names:tc:opendocument:xmlns:container"
-            }
-            rootfile_elem = container_root.find(
-                ".//c:rootfile", ns_container
-            )
-            if rootfile_elem is None:
-                return None, None, size
-
-            opf_path = rootfile_elem.get("full-path")
-            if not opf_path:
-                return None, None, size
-
-            # 2. Read OPF file
-            try:
-                opf_data = zf.read(opf_path)
-            except KeyError:
-                return None, None, size
-
-            try:
-                opf_root = ET.fromstring(opf_data)
-            except Exception:
-                return None, None, size
-
-            ns = {
-                "dc": "http://purl.org/dc/elements/1.1/",
-                "opf": "http://www.idpf.org/2007/opf",
-            }
-
-            title_el = opf_root.find(".//dc:title", ns)
-            author_el = opf_root.find(".//dc:creator", ns)
-
-            title = title_el.text.strip() if (title_el is not None and title_el.text) else ""
-            author = author_el.text.strip() if (author_el is not None and author_el.text) else ""
-
-            return title, author, size
-    except Exception:
-        return None, None, size
-
-
-def rename_epub_by_metadata(epub_path_str: str) -> Optional[Path]:
+    if epub.opf_root is None:
+        print(f"[WARN] {epub.path.name}: {epub.error}")
+        return None, None
+
+    # One lazy walk for both fields; <metadata> comes before the manifest,
+    # so it normally stops long before reaching the (possibly huge) item list
+    title = author = None
+    for el in _iter_tags(epub.opf_root, _DC_TITLE_TAG, _DC_CREATOR_TAG):
+        if el.tag == _DC_TITLE_TAG:
+            if title is None:
+                title = (el.text or "").strip()
+        elif author is None:
+            author = (el.text or "").strip()
+        if title is not None and author is not None:
+            break
+
+    return title or "", author or ""
+
+
+_INVALID_FILENAME_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def clean_filename(name: str) -> str:
+    """Remove characters that are invalid in filenames and normalize whitespace."""
+    if not name:
+        return ""
+    name = _INVALID_FILENAME_CHARS_RE.sub(" ", name.strip())
+    return _WHITESPACE_RE.sub(" ", name).strip()
+
+def rename_epub_by_metadata(epub_path: Path, title: Optional[str], author: Optional[str]) -> Optional[Path]:
     """
-    Given the full path to a single .epub file, read its metadata (title & author)
-    from the EPUB and rename the file to: 'Title - Author.epub'.
+    Given the path to an existing .epub file and the title & author read
+    from its metadata, rename the file to: 'Title - Author.epub'.
 
     Returns the new Path on success (or the original Path if no change was needed),
     or None if the file could not be renamed (e.g. missing metadata or conflict).
     """
-    epub_path = Path(epub_path_str).expanduser().resolve()
-
-    if not epub_path.is_file():
-        print(f"[ERROR] Not a file: {epub_path}")
-        return None
-
     if epub_path.suffix.lower() != ".epub":
         print(f"[ERROR] Not an .epub file: {epub_path.name}")
         return None
 
-    def clean_filename(name: str) -> str:
-        """Remove characters that are invalid in filenames and normalize whitespace."""
-        if not name:
-            return ""
-        name = name.strip()
-        invalid_chars = r'<>:"/\\|?*'
-        name = re.sub(f"[{re.escape(invalid_chars)}]", " ", name)
-        name = re.sub(r"\s+", " ", name).strip()
-        return name
-
-    def get_title_author(epub: Path) -> Tuple[Optional[str], Optional[str]]:
-        """
-        Extract (title, author) from the EPUB's OPF metadata.
-        Returns (None, None) on failure.
-        """
-        try:
-            with zipfile.ZipFile(epub, "r") as zf:
-                # 1. Read META-INF/container.xml
-                try:
-                    container_data = zf.read("META-INF/container.xml")
-                except KeyError:
-                    print(f"[WARN] {epub.name}: META-INF/container.xml not found.")
-                    return None, None
-
-                try:
-                    container_root = ET.fromstring(container_data)
-                except Exception as e:
-                    print(f"[WARN] {epub.name}: invalid container.xml: {e}")
-                    return None, None
-
-                ns_container = {
-                    "c": "urn:oasis:names:tc:opendocument:xmlns:container"
-                }
-                rootfile_elem = container_root.find(
-                    ".//c:rootfile", ns_container
-                )
-                if rootfile_elem is None:
-                    print(f"[WARN] {epub.name}: <rootfile> not found in container.xml.")
-                    return None, None
-
-                opf_path = rootfile_elem.get("full-path")
-                if not opf_path:
-                    print(f"[WARN] {epub.name}: empty full-path in container.xml.")
-                    return None, None
-
-                # 2. Read OPF file
-                try:
-                    opf_data = zf.read(opf_path)
-                except KeyError:
-                    print(f"[WARN] {epub.name}: OPF '{opf_path}' not found in archive.")
-                    return None, None
-
-                try:
-                    opf_root = ET.fromstring(opf_data)
-                except Exception as e:
-                    print(f"[WARN] {epub.name}: invalid OPF XML: {e}")
-                    return None, None
-
-                ns = {
-                    "dc": "http://purl.org/dc/elements/1.1/",
-                    "opf": "http://www.idpf.org/2007/opf",
-                }
-
-                title_el = opf_root.find(".//dc:title", ns)
-                author_el = opf_root.find(".//dc:creator", ns)
-
-                title = title_el.text.strip() if (title_el is not None and title_el.text) else ""
-                author = author_el.text.strip() if (author_el is not None and author_el.text) else ""
-
-                return title, author
-        except Exception as e:
-            print(f"[WARN] {epub.name}: error reading metadata: {e}")
-            return None, None
-
     print(f"Processing: {epub_path.name}")
 
-    title, author = get_title_author(epub_path)
     if title is None and author is None:
         print("  -> Skipping (no usable metadata).")
         return None
@@ -389,6 +525,10 @@ def rename_epub_by_metadata(epub_path_str: str) -> Optional[Path]:
 
 
 
+MAX_IMAGE_WIDTH, MAX_IMAGE_HEIGHT = 960, 540
+# Fast baseline encode; the reader shows images in 16 grey levels anyway
+JPEG_SAVE_OPTIONS = {"quality": 80, "optimize": False, "progressive": False}
+
 # Extensions to strip (Images and Fonts)
 IMAGE_EXTS = {
     '.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff'
@@ -401,6 +541,19 @@ FONT_EXTS = {
 
 REMOVE_EXTS = IMAGE_EXTS | FONT_EXTS
 
+# Image formats that are already entropy-coded; deflating them again costs
+# CPU for next to no size gain, so rewritten ones are stored
+STORED_IMAGE_EXTS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp'
+}
+
+# Suffix tuples for str.endswith(), which checks them all in one C call
+# instead of splitting every archive name with os.path.splitext()
+_IMAGE_SUFFIXES = tuple(IMAGE_EXTS)
+_FONT_SUFFIXES = tuple(FONT_EXTS)
+_REMOVE_SUFFIXES = tuple(REMOVE_EXTS)
+_STORED_IMAGE_SUFFIXES = tuple(STORED_IMAGE_EXTS)
+
 
 
 def get_image_format(ext):
@@ -421,142 +574,335 @@ def get_image_format(ext):
         return None
 
 def should_remove(filename):
-    return os.path.splitext(filename)[1].lower() in REMOVE_EXTS
+    return filename.lower().endswith(_REMOVE_SUFFIXES)
+
+_ITEM_ELEMENT = rb'<(?:\w+:)?item\b[^>]*>(?:\s*</(?:\w+:)?item>)?'
+# A manifest <item> element; one alone on its line takes the line with it
+# so dropping it leaves no blank line behind
+_MANIFEST_ITEM_RE = re.compile(rb'^[ \t]*' + _ITEM_ELEMENT + rb'[ \t]*\r?\n|' + _ITEM_ELEMENT, re.M)
+_HREF_ATTR_RE = re.compile(rb'\bhref\s*=\s*(["\'])(.*?)\1', re.S)
+
+def strip_manifest_items(opf_data: bytes, removed_basenames: set) -> Tuple[bytes, int]:
+    """
+    Drop the manifest items whose href points at a removed file, given the
+    removed files' basenames as UTF-8 bytes.
+    Returns (new_data, removed_count). One regex pass over the raw OPF bytes
+    with a set lookup per item, so the OPF is never decoded or re-encoded,
+    and minified OPFs with the whole manifest on a single line only lose
+    the matching items.
+    """
+    if not removed_basenames:
+        return opf_data, 0
 
-def process_epub(epub_path, mode='downscale'):
+    removed_count = 0
+
+    def drop_removed(match):
+        nonlocal removed_count
+        href = _HREF_ATTR_RE.search(match.group(0))
+        if href and posixpath.basename(unquote_to_bytes(href.group(2))) in removed_basenames:
+            removed_count += 1
+            return b""
+        return match.group(0)
+
+    return _MANIFEST_ITEM_RE.sub(drop_removed, opf_data), removed_count
+
+def downscale_image(filename: str, fp: BinaryIO) -> Tuple[Optional[bytes], str]:
+    """
+    Shrink one image, read from `fp`, to fit MAX_IMAGE_WIDTH x MAX_IMAGE_HEIGHT.
+    Returns (new_content, log_message); new_content is None if the image
+    already fits or cannot be re-encoded, so the entry can be copied as is.
+    Pillow only parses the header until pixels are needed, so images that
+    already fit are never decoded. Safe to run on worker threads: Pillow
+    releases the GIL while decoding, resizing and encoding.
+    """
+    try:
+        img = Image.open(fp)
+        width, height = img.size
+        max_width, max_height = MAX_IMAGE_WIDTH, MAX_IMAGE_HEIGHT
+        if width <= max_width and height <= max_height:
+            return None, f"  Kept {filename} as is ({width}x{height})"
+
+        format = get_image_format(os.path.splitext(filename)[1])
+        if not format:
+            return None, f"  Warning: Unsupported image format for {filename}, keeping as is."
+
+        # Calculate new size maintaining aspect ratio
+        ratio = min(max_width / width, max_height / height)
+        new_width = int(width * ratio)
+        new_height = int(height * ratio)
+        if img.format == 'JPEG' and ratio < 0.5:
+            # Let libjpeg scale by 1/2, 1/4 or 1/8 while decoding,
+            # staying at least twice the target size
+            img.draft(img.mode, (max_width * 2, max_height * 2))
+        # LANCZOS only pays off for large reductions on e-ink
+        resample = Image.Resampling.LANCZOS if ratio < 0.5 else Image.Resampling.BILINEAR
+        # Box-reduce by an integer factor first (what thumbnail() does), so
+        # the filter only runs on an image at most twice the target size
+        img = img.resize((new_width, new_height), resample, reducing_gap=2.0)
+
+        output = BytesIO()
+        save_options = JPEG_SAVE_OPTIONS if format == 'JPEG' else {}
+        img.save(output, format=format, **save_options)
+        return output.getvalue(), f"  Downscaled {filename} from {width}x{height} to {new_width}x{new_height}"
+    except Exception as e:
+        return None, f"  Warning: Could not downscale {filename}: {e}, keeping as is."
+
+def copy_raw_entry(zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo) -> bool:
+    """
+    Append an entry's compressed bytes from zin to zout as they are, without
+    inflating and deflating them again. zipfile has no public API for this,
+    so it writes the local header itself and registers the entry the same
+    way ZipFile.open(mode='w') does.
+    Encrypted entries pass through too, as their bytes need no decrypting.
+    Returns False, copying nothing, for ZIP64-sized entries; copy_entry()
+    streams those instead.
+    """
+    if max(info.file_size, info.compress_size) >= zipfile.ZIP64_LIMIT:
+        return False
+
+    out = copy.copy(info)
+    # 0x08 is the data descriptor flag bit; zipfile only names it from 3.11.
+    # Sizes and CRC are known up front, so they go in the local header,
+    # except for encrypted (0x01) entries: their password check byte
+    # depends on the flag, so they keep it and get a fresh descriptor.
+    if not info.flag_bits & 0x01:
+        out.flag_bits &= ~0x08
+    # zin's lock keeps image threads reading other entries off zin.fp
+    with zin._lock, zout._lock:
+        # Locate the data after the entry's local header
+        zin.fp.seek(info.header_offset)
+        fheader = struct.unpack(zipfile.structFileHeader, zin.fp.read(zipfile.sizeFileHeader))
+        if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+        zin.fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+        zout._writecheck(out)
+        zout.fp.seek(zout.start_dir)
+        out.header_offset = zout.fp.tell()
+        zout.fp.write(out.FileHeader(False))
+        remaining = info.compress_size
+        while remaining:
+            block = zin.fp.read(min(remaining, COPY_BLOCK_SIZE))
+            if not block:
+                raise zipfile.BadZipFile(f"Truncated data for {info.filename}")
+            zout.fp.write(block)
+            remaining -= len(block)
+        if out.flag_bits & 0x08:
+            zout.fp.write(struct.pack("<4sLLL", b"PK\x07\x08", out.CRC,
+                                      out.compress_size, out.file_size))
+        zout.start_dir = zout.fp.tell()
+        zout.filelist.append(out)
+        zout.NameToInfo[out.filename] = out
+        zout._didModify = True
+    return True
+
+def downscale_entry(zin: zipfile.ZipFile, info: zipfile.ZipInfo) -> Tuple[Optional[bytes], str]:
+    """downscale_image() on an archive entry, inflated only as far as it is read."""
+    with zin.open(info) as fp:
+        return downscale_image(info.filename, fp)
+
+def copy_entry(zin: zipfile.ZipFile, zout: zipfile.ZipFile, info: zipfile.ZipInfo) -> None:
+    """Copy an entry unchanged, raw when possible and streamed otherwise."""
+    if copy_raw_entry(zin, zout, info):
+        return
+    # Stream what cannot be passed through raw rather than holding the
+    # whole entry in memory. Writing fills in the ZipInfo it is given, so it
+    # gets a copy that also carries the archive's compression level.
+    out = copy.copy(info)
+    out._compresslevel = zout.compresslevel
+    with zin.open(info) as src, \
+            zout.open(out, 'w', force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as dst:
+        shutil.copyfileobj(src, dst, COPY_BLOCK_SIZE)
+
+def process_epub(zin: zipfile.ZipFile, epub_path: Path, mode='downscale',
+                 compress_level=DEFAULT_COMPRESS_LEVEL) -> Optional[Path]:
+    """
+    Write the processed copy of the book open in `zin` next to `epub_path`.
+    Returns the temporary file, which replace_epub() moves over the original
+    once `zin` is closed, or None if processing failed.
+    """
     print(f"Processing: {epub_path}")
     
     # No backup created
     
-    temp_epub = epub_path + ".tmp"
+    temp_epub = epub_path.with_name(epub_path.name + ".tmp")
     
     try:
-        with zipfile.ZipFile(epub_path, 'r') as zin, zipfile.ZipFile(temp_epub, 'w', zipfile.ZIP_DEFLATED) as zout:
+        with zipfile.ZipFile(temp_epub, 'w', zipfile.ZIP_DEFLATED, compresslevel=compress_level) as zout, \
+                ThreadPoolExecutor(max_workers=IMAGE_THREADS) as image_pool:
             
             # 1. Identify files to remove and downscale
             files_to_remove = set()
-            images_to_downscale = set()
-            all_files = zin.namelist()
+            images_to_downscale = []
+            infos = zin.infolist()
             
-            for f in all_files:
-                ext = os.path.splitext(f)[1].lower()
-                if ext in FONT_EXTS:
-                    files_to_remove.add(f)
-                elif ext in IMAGE_EXTS:
+            for item in infos:
+                name = item.filename.lower()
+                if name.endswith(_FONT_SUFFIXES):
+                    files_to_remove.add(item.filename)
+                elif name.endswith(_IMAGE_SUFFIXES):
                     if mode == 'remove':
-                        files_to_remove.add(f)
-                    elif mode == 'downscale':
-                        images_to_downscale.add(f)
+                        files_to_remove.add(item.filename)
+                    elif mode == 'downscale' and not item.flag_bits & 0x01:
+                        # Encrypted images cannot be decoded; they are copied
+                        images_to_downscale.append(item)
             
             print(f"  Found {len(files_to_remove)} files to remove (fonts{' and images' if mode=='remove' else ''}).")
             if mode == 'downscale':
                 print(f"  Found {len(images_to_downscale)} images to downscale.")
             
-            # 2. Copy files, filtering OPF content
-            for item in zin.infolist():
-                if item.filename in files_to_remove:
+            removed_basenames = {posixpath.basename(f).encode('utf-8') for f in files_to_remove}
+
+            # 2. Start downscaling every image on the pool; the copy loop
+            # below picks the results up in archive order
+            downscale_jobs = {}
+            for item in images_to_downscale:
+                downscale_jobs[item.filename] = image_pool.submit(downscale_entry, zin, item)
+            
+            # 3. The EPUB spec wants mimetype as the first entry, stored and
+            # without an extra field, wherever the source archive had it
+            mimetype_info = next((item for item in infos if item.filename == 'mimetype'), None)
+            if mimetype_info is not None:
+                zinfo = zipfile.ZipInfo('mimetype', date_time=mimetype_info.date_time)
+                zout.writestr(zinfo, zin.read(mimetype_info), zipfile.ZIP_STORED)
+            
+            # 4. Copy files, filtering OPF content
+            for item in infos:
+                if item.filename in files_to_remove or item is mimetype_info:
                     continue
                 
-                content = zin.read(item.filename)
+                # Entries left untouched keep their compressed bytes
+                if item.filename not in downscale_jobs and not item.filename.endswith('.opf'):
+                    copy_entry(zin, zout, item)
+                    continue
                 
-                # Downscale images if needed
-                if item.filename in images_to_downscale:
-                    try:
-                        img = Image.open(BytesIO(content))
-                        width, height = img.size
-                        max_width, max_height = 960, 540
-                        if width > max_width or height > max_height:
-                            # Calculate new size maintaining aspect ratio
-                            ratio = min(max_width / width, max_height / height)
-                            new_width = int(width * ratio)
-                            new_height = int(height * ratio)
-                            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-                            output = BytesIO()
-                            ext = os.path.splitext(item.filename)[1]
-                            format = get_image_format(ext)
-                            if format:
-                                img.save(output, format=format)
-                                content = output.getvalue()
-                                print(f"  Downscaled {item.filename} from {width}x{height} to {new_width}x{new_height}")
-                            else:
-                                print(f"  Warning: Unsupported image format for {item.filename}, keeping as is.")
-                        else:
-                            print(f"  Kept {item.filename} as is ({width}x{height})")
-                    except Exception as e:
-                        print(f"  Warning: Could not downscale {item.filename}: {e}, keeping as is.")
+                compress_type = None # Keep the entry's own
+                if item.filename in downscale_jobs:
+                    # Downscale images if needed
+                    content, message = downscale_jobs.pop(item.filename).result()
+                    print(message)
+                    if content is None:
+                        copy_entry(zin, zout, item)
+                        continue
+                    if item.filename.lower().endswith(_STORED_IMAGE_SUFFIXES):
+                        compress_type = zipfile.ZIP_STORED
+                else:
+                    content = zin.read(item.filename)
                 
                 # If it's an OPF file, remove references to deleted files
                 if item.filename.endswith('.opf'):
-                    try:
-                        text = content.decode('utf-8')
-                        new_lines = []
-                        removed_count = 0
-                        for line in text.splitlines():
-                            # Check if this line references any removed file
-                            drop_line = False
-                            if '<item' in line:
-                                for removed_f in files_to_remove:
-                                    if os.path.basename(removed_f) in line:
-                                        drop_line = True
-                                        break
-                            
-                            if drop_line:
-                                removed_count += 1
-                            else:
-                                new_lines.append(line)
-                        
-                        content = '\n'.join(new_lines).encode('utf-8')
-                        print(f"  Removed {removed_count} manifest entries from {item.filename}")
-                    except UnicodeDecodeError:
-                        print(f"  Warning: Could not decode {item.filename}, copying as is.")
+                    content, removed_count = strip_manifest_items(content, removed_basenames)
+                    print(f"  Removed {removed_count} manifest entries from {item.filename}")
                 
-                if item.filename == 'mimetype':
-                    zout.writestr(item, content, zipfile.ZIP_STORED)
-                else:
-                    zout.writestr(item, content)
+                # zipfile only applies the archive's compresslevel to entries
+                # it creates itself, never to a ZipInfo handed to it. It also
+                # fills in offset, sizes and CRC on the ZipInfo it is given,
+                # so it gets a copy: zin's own must keep locating the
+                # original entry for the chapter reads that follow.
+                zout.writestr(copy.copy(item), content, compress_type, compress_level)
                     
-        # Success, replace original
+        return temp_epub
+        
+    except Exception as e:
+        print(f"  Error: {e}")
+        if os.path.exists(temp_epub):
+            os.remove(temp_epub)
+        return None
+
+def replace_epub(epub_path: Path, temp_epub: Path) -> bool:
+    """
+    Replace the original book with the copy written by process_epub.
+    Returns False, leaving the original in place, if that failed.
+    """
+    try:
         shutil.move(temp_epub, epub_path)
         print("  Done.")
-        
+        return True
     except Exception as e:
         print(f"  Error: {e}")
         if os.path.exists(temp_epub):
             os.remove(temp_epub)
+        return False
 
 def sanitize(s: str) -> str:
     """Sanitize string for index file, replacing problematic characters."""
     return s.replace('|', '-').replace('\n', ' ').replace('\r', ' ')
 
-def process_single_epub(epub_path_str: str, mode: str):
+def process_single_epub(epub_path_str: str, mode: str, compress_level: int = DEFAULT_COMPRESS_LEVEL):
+    # Deliberately not resolved: a symlinked book is processed through the
+    # link itself, so the rewrite, the rename and the sidecar files all stay
+    # in the target directory instead of landing next to the link target
     epub_path = Path(epub_path_str)
+    # The book may have been removed or renamed since main() listed it
     if not epub_path.is_file():
+        print(f"[ERROR] Not a file: {epub_path}")
         return None
 
-    process_epub(str(epub_path), mode)
-    final_path = rename_epub_by_metadata(str(epub_path))
+    cached = load_cached_result(epub_path, epub_path.stat(), mode, compress_level)
+    if cached:
+        print(f"Unchanged since last run: {epub_path.name}")
+        return cached
+
+    # Rewrite the book and read the metadata from the same open archive;
+    # process_epub() never modifies zin or its ZipInfos, and leaves the OPF
+    # metadata as it was. The handles are closed before replacing and
+    # renaming the file, which Windows refuses on open files.
+    title, author = None, None
+    temp_epub = None
+    chapter_offsets = None
+    metrics_failed = False
+    read_failed = True
+    try:
+        with EpubHandle(epub_path) as epub:
+            temp_epub = process_epub(epub.zf, epub_path, mode, compress_level)
+            title, author = get_title_author(epub)
+            if not get_metrics_path(epub_path).exists():
+                # Measure the book the reader will open: spine entries can be
+                # images (fixed-layout books) that were just downscaled or
+                # removed along with their manifest items
+                if temp_epub is not None:
+                    with EpubHandle(temp_epub) as processed:
+                        chapter_offsets = compute_chapter_offsets(processed)
+                else:
+                    chapter_offsets = compute_chapter_offsets(epub)
+                metrics_failed = chapter_offsets is None
+        read_failed = False
+    except Exception as e:
+        print(f"[WARN] {epub_path.name}: error reading metadata: {e}")
+
+    processed = temp_epub is not None and replace_epub(epub_path, temp_epub)
+    st = epub_path.stat()
+
+    final_path = rename_epub_by_metadata(epub_path, title, author)
     if final_path is None:
         final_path = epub_path
 
-    has_metrics = 1 if generate_metrics(final_path) else 0
+    has_metrics = 0 if metrics_failed else (1 if generate_metrics(final_path, chapter_offsets) else 0)
 
-    title, author, size = get_metadata(final_path)
     if title is None:
         title = final_path.stem
 
-    return {
+    result = {
         "name": final_path.name,
         "title": title,
         "author": author,
-        "size": size,
+        "size": st.st_size,
         "has_metrics": has_metrics,
     }
+    # Only a book that went through the whole pipeline may be skipped next
+    # time; anything that failed is retried. Renaming keeps the size and
+    # mtime read above.
+    if processed and not read_failed:
+        save_cached_result(final_path, st, mode, compress_level, result)
+    return result
 
 def main():
     parser = argparse.ArgumentParser(description="Process EPUB files: downscale images or remove them.")
     parser.add_argument('target_dir', nargs='?', default=os.getcwd(), help="Directory containing EPUB files (default: current directory)")
     parser.add_argument('--mode', choices=['downscale', 'remove'], default='downscale', help="Mode: 'downscale' to resize large images, 'remove' to remove images (default: downscale)")
     parser.add_argument('--workers', type=int, default=0, help="Number of worker processes (0 = auto)")
+    parser.add_argument('--compress-level', type=int, choices=range(10), default=DEFAULT_COMPRESS_LEVEL, metavar='0-9',
+                        help=f"Deflate level for rewritten entries (default: {DEFAULT_COMPRESS_LEVEL})")
     
     args = parser.parse_args()
     target_dir = args.target_dir
@@ -565,11 +911,14 @@ def main():
     print(f"Scanning directory: {target_dir}")
     print(f"Mode: {mode}")
     
-    epub_paths = [
-        os.path.join(target_dir, filename)
-        for filename in sorted(os.listdir(target_dir))
-        if filename.lower().endswith('.epub')
-    ]
+    # DirEntry carries the file type from the directory listing, so this
+    # needs no per-file stat() call
+    with os.scandir(target_dir) as it:
+        epub_entries = sorted(
+            (entry for entry in it if entry.name.lower().endswith('.epub') and entry.is_file()),
+            key=lambda e: e.name,
+        )
+    epub_paths = [entry.path for entry in epub_entries]
 
     if not epub_paths:
         print("No .epub files found in this directory.")
@@ -580,13 +929,22 @@ def main():
 
     results = []
     if max_workers > 1:
-        with ProcessPoolExecutor(max_workers=max_workers) as executor:
-            for result in executor.map(process_single_epub, epub_paths, itertools.repeat(mode)):
-                if result:
-                    results.append(result)
+        # Start the largest books first so a big one does not end up running
+        # alone at the end; results go back into name order for the index
+        by_size = sorted(epub_entries, key=lambda e: e.stat().st_size, reverse=True)
+        pool_options = {"max_tasks_per_child": BOOKS_PER_WORKER} if sys.version_info >= (3, 11) else {}
+        results_by_path = {}
+        with ProcessPoolExecutor(max_workers=max_workers, **pool_options) as executor:
+            futures = {
+                executor.submit(process_single_epub, entry.path, mode, args.compress_level): entry.path
+                for entry in by_size
+            }
+            for future in as_completed(futures):
+                results_by_path[futures[future]] = future.result()
+        results = [results_by_path[path] for path in epub_paths if results_by_path[path]]
     else:
         for path in epub_paths:
-            result = process_single_epub(path, mode)
+            result = process_single_epub(path, mode, args.compress_level)
             if result:
                 results.append(result)
 
@@ -603,8 +961,7 @@ def main():
     # Write index.txt
     index_file = os.path.join(target_dir, "index.txt")
     with open(index_file, 'w', encoding='utf-8') as f:
-        for entry in index_entries:
-            f.write(entry + '\n')
+        f.write(''.join(entry + '\n' for entry in index_entries))
     print(f"Generated index.txt with {len(index_entries)} entries.")
 
 if __name__ == '__main__':
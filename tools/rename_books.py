@@ -4,9 +4,15 @@ import sys
 def rename_epubs(directory):
     print(f"Renaming EPUBs in {directory}...")
     
-    files = [f for f in os.listdir(directory) if f.lower().endswith('.epub')]
+    names = os.listdir(directory)
+    files = [f for f in names if f.lower().endswith('.epub')]
     files.sort() # Sort to have deterministic order
     
+    # Names already in the directory, so collisions are checked in memory
+    # instead of with one os.path.exists() call per candidate. Lowercased so
+    # case-insensitive filesystems never get an existing file overwritten.
+    taken = {f.lower() for f in names}
+    
     count = 0
     for i, filename in enumerate(files):
         old_path = os.path.join(directory, filename)
@@ -17,17 +23,17 @@ def rename_epubs(directory):
             print(f"Skipping {filename}, already renamed.")
             continue
             
-        new_name = f"book_{i+1}.epub"
-        new_path = os.path.join(directory, new_name)
-        
         # Handle collision if target exists (e.g. from previous run)
-        while os.path.exists(new_path):
-            i += 1
-            new_name = f"book_{i+1}.epub"
-            new_path = os.path.join(directory, new_name)
+        book_num = i + 1
+        while f"book_{book_num}.epub" in taken:
+            book_num += 1
+        new_name = f"book_{book_num}.epub"
+        new_path = os.path.join(directory, new_name)
             
         try:
             os.rename(old_path, new_path)
+            taken.discard(filename.lower())
+            taken.add(new_name)
             print(f"Renamed: '{filename}' -> '{new_name}'")
             count += 1
         except Exception as e:
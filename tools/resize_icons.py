@@ -1,26 +1,47 @@
 import os
+from multiprocessing import Pool
 from PIL import Image
 
-# Directory containing the icons
-script_dir = os.path.dirname(os.path.abspath(__file__))
-icon_dir = os.path.join(script_dir, '../spiffs_image/icons')
-icon_dir = os.path.abspath(icon_dir)
-
-# Ensure the directory exists
-if not os.path.exists(icon_dir):
-    print(f"Directory {icon_dir} does not exist.")
-    exit(1)
-
-# Process each file in the directory
-for filename in os.listdir(icon_dir):
-    if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-        filepath = os.path.join(icon_dir, filename)
-        try:
-            img = Image.open(filepath)
-            img_resized = img.resize((96, 96), Image.Resampling.LANCZOS)
-            img_resized.save(filepath)
-            print(f"Resized {filename} to 96x96")
-        except Exception as e:
-            print(f"Error processing {filename}: {e}")
-
-print("All images resized.")
\ No newline at end of file
+ICON_SIZE = (96, 96)
+ICON_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+def resize_icon(filepath):
+    """Resize one icon in place to ICON_SIZE. Returns a status line to print."""
+    filename = os.path.basename(filepath)
+    try:
+        with Image.open(filepath) as img:
+            # Already the right size; re-saving would only re-encode it
+            if img.size == ICON_SIZE:
+                return f"Kept {filename} ({ICON_SIZE[0]}x{ICON_SIZE[1]})"
+            img_resized = img.resize(ICON_SIZE, Image.Resampling.LANCZOS)
+        img_resized.save(filepath)
+        return f"Resized {filename} to {ICON_SIZE[0]}x{ICON_SIZE[1]}"
+    except Exception as e:
+        return f"Error processing {filename}: {e}"
+
+def main():
+    # Directory containing the icons
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    icon_dir = os.path.join(script_dir, '../spiffs_image/icons')
+    icon_dir = os.path.abspath(icon_dir)
+
+    # Ensure the directory exists
+    if not os.path.exists(icon_dir):
+        print(f"Directory {icon_dir} does not exist.")
+        exit(1)
+
+    filepaths = [
+        os.path.join(icon_dir, filename)
+        for filename in os.listdir(icon_dir)
+        if filename.lower().endswith(ICON_EXTS)
+    ]
+
+    # Icons are independent, so resize them on all cores
+    with Pool() as pool:
+        for status in pool.imap(resize_icon, filepaths):
+            print(status)
+
+    print("All images resized.")
+
+if __name__ == '__main__':
+    main()
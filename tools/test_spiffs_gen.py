@@ -1,6 +1,5 @@
 import sys
 import os
-import shutil
 
 # Add ESP-IDF spiffs component to path
 idf_path = os.environ.get('IDF_PATH')
@@ -19,41 +18,42 @@ except ImportError:
 
 def test_spiffs_generation():
     base_dir = "test_spiffs_dir"
-    if os.path.exists(base_dir):
-        shutil.rmtree(base_dir)
-    os.makedirs(base_dir)
+    # The same two files are rewritten every run, so there is nothing to wipe
+    os.makedirs(base_dir, exist_ok=True)
     
     # Create a file with Hebrew name
     filename = "ספר המסעות אפריים קישון.epub"
-    with open(os.path.join(base_dir, filename), 'w', encoding='utf-8') as f:
-        f.write("Hello World" * 100)
+    with open(os.path.join(base_dir, filename), 'wb') as f:
+        f.write(b"Hello World" * 100)
         
     # Create a file in a subdirectory
     os.makedirs(os.path.join(base_dir, "fonts"), exist_ok=True)
-    with open(os.path.join(base_dir, "fonts", "NotoSansHebrew-Regular.vlw"), 'w', encoding='utf-8') as f:
-        f.write("Font Data")
+    with open(os.path.join(base_dir, "fonts", "NotoSansHebrew-Regular.vlw"), 'wb') as f:
+        f.write(b"Font Data")
         
     image_file = "test_spiffs.bin"
     
-    # Args: image_size, base_dir, output_file, page_size, obj_name_len, meta_len, use_magic, use_magic_len
-    # spiffsgen.main() parses args. We can call spiffsgen.SpiffsBuildConfig directly?
-    # Or just invoke main with sys.argv
-    
-    sys.argv = [
-        "spiffsgen.py",
-        "0x100000", # 1MB
-        base_dir,
-        image_file,
-        "--page-size=256",
-        "--obj-name-len=64",
-        "--meta-len=4",
-        "--use-magic",
-        "--use-magic-len"
-    ]
+    # Build the config spiffsgen.main() would derive from
+    # "0x100000 --page-size=256 --obj-name-len=64 --meta-len=4 --use-magic
+    # --use-magic-len", without going through sys.argv and argparse
+    build_config = spiffsgen.SpiffsBuildConfig(
+        256, spiffsgen.SPIFFS_PAGE_IX_LEN,                # page size
+        4096, spiffsgen.SPIFFS_BLOCK_IX_LEN,              # block size
+        4, 64,                                            # meta len, obj name len
+        spiffsgen.SPIFFS_OBJ_ID_LEN, spiffsgen.SPIFFS_SPAN_IX_LEN,
+        True, True, 'little',                             # packed, aligned, endianness
+        True, True,                                       # use magic, use magic len
+        False)                                            # aligned obj ix tables
     
     print("Running spiffsgen with Hebrew filename...")
     try:
-        spiffsgen.main()
+        spiffs = spiffsgen.SpiffsFS(0x100000, build_config) # 1MB
+        for root, dirs, files in os.walk(base_dir):
+            for f in files:
+                full_path = os.path.join(root, f)
+                spiffs.create_file('/' + os.path.relpath(full_path, base_dir).replace('\\', '/'), full_path)
+        with open(image_file, 'wb') as f:
+            f.write(spiffs.to_binary())
         print("Success!")
     except Exception as e:
         print(f"Failed: {e}")